@@ -2,16 +2,18 @@
 import hashlib
 import json
 import logging
+import mmap
 import os
 import re
 import subprocess  # nosec
 import sys
-import tempfile
 import venv
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import cached_property
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("build")
@@ -20,6 +22,7 @@ logger = logging.getLogger("build")
 this_dir = Path(__file__).parent
 this_file = Path(__file__).name
 package_manager = "poetry>=1.6.1"
+package_manager_name_regex = re.compile(r"^([a-zA-Z0-9_-]+)")
 
 
 class Runnable(ABC):
@@ -42,9 +45,12 @@ class Runnable(ABC):
 
 class RunInfoStatus(Enum):
     MATCH = (False, "Nothing changed. Previous execution info matches.")
+    METADATA_CHANGED = (False, "File contents match. Only file metadata changed.")
     NO_INFO = (True, "No previous execution info found.")
     FILE_NOT_FOUND = (True, "File not found.")
     FILE_CHANGED = (True, "File has changed.")
+    FILES_CHANGED = (True, "Runnable inputs or outputs have changed.")
+    FORCED = (True, "Execution forced.")
 
     def __init__(self, should_run: bool, message: str) -> None:
         self.should_run = should_run
@@ -59,68 +65,190 @@ class Executor:
     and if they match, it skips the execution."""
 
     RUN_INFO_FILE_EXTENSION = ".deps.json"
+    # Files are hashed in chunks to avoid loading them completely into memory
+    HASH_CHUNK_SIZE = 1 << 16
+    # Larger files are memory mapped and hashed in a single call
+    HASH_MMAP_MIN_SIZE = 1 << 20
+    # The hash is only used to detect changes, not for security.
+    # An 8 byte BLAKE2b digest (16 hex characters) is fast and sufficient.
+    HASH_DIGEST_SIZE = 8
 
     def __init__(self, cache_dir: Path) -> None:
         self.cache_dir = cache_dir
+        # Hashes shared by all executions, keyed by (path, mtime, size), such that
+        # files used by several runnables are only hashed once
+        self._hash_cache: Dict[Tuple[str, int, int], str] = {}
+        self._hash_pool: Optional[ThreadPoolExecutor] = None
+        # Copying a prepared hasher is cheaper than constructing a new one per file
+        self._hash_template = hashlib.blake2b(digest_size=self.HASH_DIGEST_SIZE)
+
+    def get_file_hash(
+        self, path: str | Path, stat: Optional[os.stat_result] = None
+    ) -> str:
+        stat = stat or os.stat(path)
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+        if key in self._hash_cache:
+            return self._hash_cache[key]
+        hasher = self._hash_template.copy()
+        with open(path, "rb", buffering=0) as file:
+            if stat.st_size > self.HASH_MMAP_MIN_SIZE:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+            else:
+                for chunk in iter(lambda: file.read(self.HASH_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+        self._hash_cache[key] = hasher.hexdigest()
+        return self._hash_cache[key]
+
+    def get_file_hashes(self, stats: Dict[str, os.stat_result]) -> Dict[str, str]:
+        """Hash the files in parallel. hashlib releases the GIL while hashing."""
+        if len(stats) < 2:
+            return {
+                path: self.get_file_hash(path, stat) for path, stat in stats.items()
+            }
+        if not self._hash_pool:
+            self._hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        hashes = self._hash_pool.map(self.get_file_hash, stats, stats.values())
+        return dict(zip(stats, hashes))
 
     @staticmethod
-    def get_file_hash(path: Path) -> str:
-        with open(path, "rb") as file:
-            bytes = file.read()
-            readable_hash = hashlib.sha256(bytes).hexdigest()
-            return readable_hash
+    def get_file_info(stat: os.stat_result, file_hash: str) -> Dict[str, Any]:
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": file_hash,
+        }
+
+    @staticmethod
+    def stat_matches(stat: os.stat_result, file_info: Dict[str, Any]) -> bool:
+        return (
+            stat.st_size == file_info["size"]
+            and stat.st_mtime_ns == file_info["mtime_ns"]
+        )
+
+    def store_run_info(
+        self,
+        runnable: Runnable,
+        inputs: List[str],
+        outputs: List[str],
+        known_file_infos: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> None:
+        """Store the run info. Files which did not change since they were
+        checked reuse their known hash and are not hashed again."""
+        known_file_infos = known_file_infos or {}
+
+        file_infos: Dict[str, Dict[str, Any]] = {}
+        stats: Dict[str, os.stat_result] = {}
+        for path_str in inputs + outputs:
+            stat = os.stat(path_str)
+            known_file_info = known_file_infos.get(path_str)
+            if known_file_info and self.stat_matches(stat, known_file_info):
+                file_infos[path_str] = known_file_info
+            else:
+                stats[path_str] = stat
+        hashes = self.get_file_hashes(stats)
+        for path_str, stat in stats.items():
+            file_infos[path_str] = self.get_file_info(stat, hashes[path_str])
 
-    def store_run_info(self, runnable: Runnable) -> None:
         file_info = {
-            "inputs": {
-                str(path): self.get_file_hash(path) for path in runnable.get_inputs()
-            },
-            "outputs": {
-                str(path): self.get_file_hash(path) for path in runnable.get_outputs()
-            },
+            "inputs": {path_str: file_infos[path_str] for path_str in inputs},
+            "outputs": {path_str: file_infos[path_str] for path_str in outputs},
         }
 
         run_info_path = self.get_runnable_run_info_file(runnable)
         run_info_path.parent.mkdir(parents=True, exist_ok=True)
         with run_info_path.open("w") as f:
-            # pretty print the json file
-            json.dump(file_info, f, indent=4)
+            # the file is only read by this script, keep it compact
+            json.dump(file_info, f, separators=(",", ":"))
 
     def get_runnable_run_info_file(self, runnable: Runnable) -> Path:
         return self.cache_dir / f"{runnable.get_name()}{self.RUN_INFO_FILE_EXTENSION}"
 
-    def previous_run_info_matches(self, runnable: Runnable) -> RunInfoStatus:
+    def previous_run_info_matches(
+        self, runnable: Runnable, inputs: List[str], outputs: List[str]
+    ) -> Tuple[RunInfoStatus, Dict[str, Dict[str, Any]]]:
+        """Check the previous run info. Besides the status, return the info
+        of all files checked so far to be reused when storing the run info."""
+        known_file_infos: Dict[str, Dict[str, Any]] = {}
         run_info_path = self.get_runnable_run_info_file(runnable)
         if not run_info_path.exists():
-            return RunInfoStatus.NO_INFO
+            return RunInfoStatus.NO_INFO, known_file_infos
 
         with run_info_path.open() as f:
             previous_info = json.load(f)
-
+        # The runnable might declare other files than in the previous run
+        for file_type, paths in [("inputs", inputs), ("outputs", outputs)]:
+            if set(previous_info[file_type]) != set(paths):
+                return RunInfoStatus.FILES_CHANGED, known_file_infos
+
+        # Collect the files which might have changed and hash them all at once
+        previous_hashes: Dict[str, str] = {}
+        stats: Dict[str, os.stat_result] = {}
         for file_type in ["inputs", "outputs"]:
-            for path_str, previous_hash in previous_info[file_type].items():
-                path = Path(path_str)
-                if not path.exists():
-                    return RunInfoStatus.FILE_NOT_FOUND
-                elif self.get_file_hash(path) != previous_hash:
-                    return RunInfoStatus.FILE_CHANGED
-        return RunInfoStatus.MATCH
-
-    def execute(self, runnable: Runnable) -> int:
-        run_info_status = self.previous_run_info_matches(runnable)
+            for path_str, previous_file_info in previous_info[file_type].items():
+                try:
+                    stat = os.stat(path_str)
+                except FileNotFoundError:
+                    return RunInfoStatus.FILE_NOT_FOUND, known_file_infos
+                if not isinstance(previous_file_info, dict):
+                    # Run info stored by an older version of this script
+                    return RunInfoStatus.FILE_CHANGED, known_file_infos
+                # Only hash the file if its size or modification time changed
+                if self.stat_matches(stat, previous_file_info):
+                    known_file_infos[path_str] = previous_file_info
+                    continue
+                previous_hashes[path_str] = previous_file_info["hash"]
+                stats[path_str] = stat
+
+        hashes = self.get_file_hashes(stats)
+        for path_str, stat in stats.items():
+            known_file_infos[path_str] = self.get_file_info(stat, hashes[path_str])
+        for path_str, previous_hash in previous_hashes.items():
+            if hashes[path_str] != previous_hash:
+                return RunInfoStatus.FILE_CHANGED, known_file_infos
+        if stats:
+            return RunInfoStatus.METADATA_CHANGED, known_file_infos
+        return RunInfoStatus.MATCH, known_file_infos
+
+    def execute(self, runnable: Runnable, force: bool = False) -> int:
+        # The runnable creates new path lists on every call, get them only once
+        inputs = [str(path) for path in runnable.get_inputs()]
+        outputs = [str(path) for path in runnable.get_outputs()]
+        known_file_infos: Dict[str, Dict[str, Any]] = {}
+        if force:
+            run_info_status = RunInfoStatus.FORCED
+        else:
+            run_info_status, known_file_infos = self.previous_run_info_matches(
+                runnable, inputs, outputs
+            )
         if run_info_status.should_run:
             logger.info(
                 f"Runnable '{runnable.get_name()}' must run. {run_info_status.message}"
             )
             exit_code = runnable.run()
-            self.store_run_info(runnable)
+            self.store_run_info(runnable, inputs, outputs, known_file_infos)
             return exit_code
         logger.info(
             f"Runnable '{runnable.get_name()}' execution skipped. {run_info_status.message}"
         )
+        if run_info_status is RunInfoStatus.METADATA_CHANGED:
+            # Update the stored metadata such that the files are not hashed again
+            self.store_run_info(runnable, inputs, outputs, known_file_infos)
 
         return 0
 
+    def close(self) -> None:
+        if self._hash_pool:
+            self._hash_pool.shutdown()
+            self._hash_pool = None
+        self._hash_cache.clear()
+
+    def __enter__(self) -> "Executor":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
 
 class UserNotificationException(Exception):
     pass
@@ -129,13 +257,16 @@ class UserNotificationException(Exception):
 class SubprocessExecutor:
     def __init__(
         self,
-        command: List[str | Path],
+        command: Sequence[str | Path],
         cwd: Optional[Path] = None,
         capture_output: bool = True,
+        env: Optional[Dict[str, str]] = None,
     ):
-        self.command = " ".join([str(cmd) for cmd in command])
+        self.argv = [str(cmd) for cmd in command]
+        self.command = " ".join(self.argv)
         self.current_working_directory = cwd
         self.capture_output = capture_output
+        self.env = env
 
     def execute(self) -> None:
         result = None
@@ -143,11 +274,13 @@ class SubprocessExecutor:
             current_dir = (self.current_working_directory or Path.cwd()).as_posix()
             logger.info(f"Running command: {self.command} in {current_dir}")
             # print all virtual environment variables
-            logger.debug(json.dumps(dict(os.environ), indent=4))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(json.dumps(dict(self.env or os.environ), indent=4))
             result = subprocess.run(
-                self.command.split(),
+                self.argv,
                 cwd=current_dir,
                 capture_output=self.capture_output,
+                env=self.env,
                 text=True,  # to get stdout and stderr as strings instead of bytes
             )  # nosec
             result.check_returncode()
@@ -157,6 +290,11 @@ class SubprocessExecutor:
                 f"{result.stdout if result else ''}\n"
                 f"{result.stderr if result else e}"
             )
+        except OSError as e:
+            # e.g. the executable could not be found
+            raise UserNotificationException(
+                f"Command '{self.command}' failed with:\n{e}"
+            )
 
 
 class VirtualEnvironment(ABC):
@@ -215,7 +353,7 @@ class WindowsVirtualEnvironment(VirtualEnvironment):
 
     def run(self, args: List[str], capture_output: bool = True) -> None:
         SubprocessExecutor(
-            [f"cmd /c {self.activate_script.as_posix()} && ", *args],
+            ["cmd", "/c", self.activate_script.as_posix(), "&&", *args],
             this_dir,
             capture_output,
         ).execute()
@@ -224,43 +362,36 @@ class WindowsVirtualEnvironment(VirtualEnvironment):
 class UnixVirtualEnvironment(VirtualEnvironment):
     def __init__(self, venv_dir: Path) -> None:
         super().__init__(venv_dir)
-        self.activate_script = self.venv_dir.joinpath("bin/activate")
 
     def pip(self, args: List[str]) -> None:
         pip_path = self.venv_dir.joinpath("bin/pip").as_posix()
         SubprocessExecutor([pip_path, *args]).execute()
 
     def run(self, args: List[str], capture_output: bool = True) -> None:
-        # Create a temporary shell script
-        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".sh") as f:
-            f.write("#!/bin/bash\n")  # Add a shebang line
-            f.write(
-                f"source {self.activate_script.as_posix()}\n"
-            )  # Write the activate command
-            f.write(" ".join(args))  # Write the provided command
-            temp_script_path = f.name  # Get the path of the temporary script
-
-        # Make the temporary script executable
-        SubprocessExecutor(["chmod", "+x", temp_script_path]).execute()
-        # Run the temporary script
-        SubprocessExecutor(
-            [f"{Path(temp_script_path).as_posix()}"], this_dir, capture_output
-        ).execute()
-        # Delete the temporary script
-        os.remove(temp_script_path)
+        # Activate the virtual environment by setting up the environment variables
+        # the same way the activate script does it
+        env = os.environ.copy()
+        env["VIRTUAL_ENV"] = self.venv_dir.as_posix()
+        env["PATH"] = os.pathsep.join(
+            [self.venv_dir.joinpath("bin").as_posix(), env.get("PATH", "")]
+        )
+        env.pop("PYTHONHOME", None)
+        SubprocessExecutor(args, this_dir, capture_output, env).execute()
 
 
 class CreateVirtualEnvironment(Runnable):
     def __init__(
         self,
+        clean: bool = False,
     ) -> None:
+        self.clean = clean
         self.root_dir = this_dir
         self.venv_dir = self.root_dir / ".venv"
         self.virtual_env = self.instantiate_os_specific_venv()
 
-    @property
+    @cached_property
     def package_manager_name(self) -> str:
-        match = re.match(r"^([a-zA-Z0-9_-]+)", package_manager)
+        match = package_manager_name_regex.match(package_manager)
 
         if match:
             return match.group(1)
@@ -271,7 +402,8 @@ class CreateVirtualEnvironment(Runnable):
 
     def run(self) -> int:
         logger.info("Running project build script")
-        self.virtual_env.create(clear=self.venv_dir.exists())
+        # An existing virtual environment is updated, only clear it if requested
+        self.virtual_env.create(clear=self.clean)
         self.virtual_env.pip(["install", package_manager])
         self.virtual_env.run([self.package_manager_name, "install"])
         return 0
@@ -301,8 +433,9 @@ class CreateVirtualEnvironment(Runnable):
 
 def print_environment_info() -> None:
     str_bar = "".join(["-" for _ in range(80)])
-    logger.debug(str_bar)
-    logger.debug("Environment: \n" + json.dumps(dict(os.environ), indent=4))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(str_bar)
+        logger.debug("Environment: \n" + json.dumps(dict(os.environ), indent=4))
     logger.info(str_bar)
     logger.info(f"Arguments: {sys.argv[1:]}")
     logger.info(str_bar)
@@ -311,11 +444,16 @@ def print_environment_info() -> None:
 def main() -> int:
     try:
         # print_environment_info()
-        build = CreateVirtualEnvironment()
-        Executor(build.venv_dir).execute(build)
+        args = sys.argv[1:]
+        # '--clean' recreates the virtual environment from scratch
+        clean = "--clean" in args
+        if clean:
+            args.remove("--clean")
+        build = CreateVirtualEnvironment(clean)
+        with Executor(build.venv_dir) as executor:
+            executor.execute(build, force=clean)
         # In case there is a yanga.yml file and the script was called with arguments,
         # run 'yanga build' with all input arguments
-        args = sys.argv[1:]
         if this_dir.joinpath("yanga.yaml").exists() and len(args) > 0:
             build.virtual_env.run(["yanga", "build"] + args, False)
     except UserNotificationException as e:
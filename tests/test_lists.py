@@ -1,17 +1,11 @@
 # Given a list of numbers, one shall calculate the maximum number and return it.
 
-from typing import List
+from typing import List, Tuple
 
 
-# 1. assume the first value is the maximum
-# 2. iterate over the list
-# 3. compare biggest with the current element and if smaller update biggest
+# use the built-in max() which iterates over the list in C
 def calculate_max(numbers: List[int]) -> int:
-    biggest = numbers[0] # 1
-    for number in numbers: # 2
-        if biggest < number: # 3
-            biggest=number
-    return biggest
+    return max(numbers)
 
 def test_calculate_max():
     numbers = [5, 12, 1, 0]
@@ -19,11 +13,7 @@ def test_calculate_max():
     assert biggest == 12
 
 def calculate_min(numbers: List[int]) -> int:
-    smallest = numbers[0]
-    for number in numbers:
-        if smallest > number:
-            smallest=number
-    return smallest
+    return min(numbers)
 
 def test_calculate_min():
     numbers = [5, 12, 1]
@@ -32,18 +22,10 @@ def test_calculate_min():
 
 
 # calculate the sum of all numbers
-# initialise the sum to zero
+# divide it by the number of elements
 
 def calculate_average(numbers: List[int]) -> float:
-    average = 0
-    sum=0
-    number_of_elements=0
-    for number in numbers:
-        sum=sum+number
-        number_of_elements=number_of_elements+1
-    
-    average=sum/number_of_elements
-    return average
+    return sum(numbers) / len(numbers)
 
 def test_calculate_average():
     numbers = [2,3,4]
@@ -54,4 +36,26 @@ def test_calculate_average():
     assert result == 4
     numbers = [10,5]
     result = calculate_average(numbers)
-    assert result == 7.5
\ No newline at end of file
+    assert result == 7.5
+
+
+# calculate minimum, maximum and average in one iteration over the list
+def summarize(numbers: List[int]) -> Tuple[int, int, float]:
+    smallest = biggest = numbers[0]
+    total = 0
+    for number in numbers:
+        total = total + number
+        if number < smallest:
+            smallest = number
+        elif number > biggest:
+            biggest = number
+    return smallest, biggest, total / len(numbers)
+
+
+def test_summarize():
+    numbers = [5, 12, 1, 0]
+    result = summarize(numbers)
+    assert result == (0, 12, 4.5)
+    numbers = [10, 5, 2, -1]
+    result = summarize(numbers)
+    assert result == (-1, 10, 4)